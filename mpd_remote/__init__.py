@@ -1,4 +1,7 @@
+import os
 import random
+import select
+import subprocess
 import time
 import sys
 import logging
@@ -6,8 +9,11 @@ import traceback
 
 from pathlib import Path
 from typing import List, Dict, Union, Callable, Optional, Tuple
-from termios import tcflush, TCIOFLUSH
+from termios import tcflush, tcgetattr, tcsetattr, TCIOFLUSH, TCSADRAIN
+from tty import setcbreak
 from contextlib import contextmanager
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 
 from readchar import readkey, key
 
@@ -20,18 +26,27 @@ class MuteContext:
     """MuteContext can be used to mute the currently playing audio
     so that you can speak to the user."""
 
-    def __init__(self, api: Client):
+    def __init__(self, api: Client, ttl: float = 1.0):
         self.api = api
+        self.ttl = ttl
         self.resume = False
         self.update()
 
     def update(self):
         self.status, self.playlist = self.api.status()
+        self._updated = time.monotonic()
+
+    def revalidate(self):
+        """Update status and playlist only if they are older than ttl seconds."""
+        if time.monotonic() - self._updated > self.ttl:
+            self.update()
 
     def is_stopped(self) -> bool:
+        self.revalidate()
         return self.status["state"] == "stop"
 
     def current(self) -> Optional[Track]:
+        self.revalidate()
         if not self.is_stopped():
             return self.playlist[int(self.status["song"])]
         elif self.playlist:
@@ -47,6 +62,7 @@ class MuteContext:
 
     def __enter__(self):
         logging.debug("Entering mute context.")
+        self.revalidate()
         if self.status["state"] == "play":
             self.resume = True
             self.api.pause()
@@ -61,28 +77,112 @@ class MuteContext:
 class Remote:
     """Remote is a super-class supporting basic remote functionality."""
 
-    EXIT_KEYS = [key.CTRL_C, key.CTRL_D]
-    BACK_KEYS = EXIT_KEYS + ["\x7f", "b"]
-    PREV_KEYS = BACK_KEYS + [key.LEFT]
-    ENTER_KEYS = ["\r", "\n", key.RIGHT]
+    EXIT_KEYS = frozenset({key.CTRL_C, key.CTRL_D})
+    BACK_KEYS = EXIT_KEYS | frozenset({"\x7f", "b"})
+    PREV_KEYS = BACK_KEYS | frozenset({key.LEFT})
+    ENTER_KEYS = frozenset({"\r", "\n", key.RIGHT})
+    FLUSH_QUIET_SECONDS = 0.16
+    POLL_SECONDS = 0.02
+
+    # Map each input character to the name of the method that handles it.
+    # The table is shared by all instances, so it is only built once.
+    ACTIONS: Dict[str, str] = {}
 
     def __init__(self, mpd_client):
         self._client = mpd_client
-        self._actions: Dict[str, Callable[None, []]] = dict()
         self._input_char = None
         self._flush_seconds = 0.250
+        self._numbers: Dict[int, Speech] = dict()
+        self._prefetch_executor = ThreadPoolExecutor(max_workers=2)
+        self._prefetching: "OrderedDict[str, Future]" = OrderedDict()
+        self.prefetch_numbers()
+
+    def prefetch_numbers(self, limit: int = 100) -> None:
+        """Synthesize the numbers used to announce menu and search entries and
+        keep their audio in memory."""
+
+        def fetch(num: int) -> Optional[Speech]:
+            try:
+                # The audio is kept for the whole run, so do not settle for
+                # the local voice; number_speech() falls back per utterance.
+                return Speech(str(num)).prefetch(fallback=False)
+            except Exception as err:
+                logging.debug("Cannot prefetch number %s: %s", num, err)
+                return None
+
+        with ThreadPoolExecutor(8) as executor:
+            for num, speech in enumerate(executor.map(fetch, range(limit + 1))):
+                if speech is not None:
+                    self._numbers[num] = speech
+        if len(self._numbers) <= limit:
+            logging.warning("Could not prefetch all numbers, continuing anyway.")
+
+    def prefetch_async(self, text: str) -> None:
+        """Synthesize text in the background, so that it is cached by the time
+        it should be spoken."""
+        if text in self._prefetching:
+            self._prefetching.move_to_end(text)
+            return
+
+        def fetch() -> Optional[Speech]:
+            try:
+                return Speech(text).prefetch()
+            except Exception as err:
+                logging.debug("Cannot prefetch %r: %s", text, err)
+                return None
+
+        self._prefetching[text] = self._prefetch_executor.submit(fetch)
+        while len(self._prefetching) > 64:
+            self._prefetching.popitem(last=False)
+
+    def cancel_prefetch(self, text: str) -> None:
+        """Drop a background prefetch of text that has not started yet."""
+        future = self._prefetching.get(text)
+        if future is not None and future.cancel():
+            del self._prefetching[text]
+
+    def prefetched(self, text: str) -> Speech:
+        """Return speech for text with its audio, using a background prefetch
+        of text if there is one rather than synthesizing it a second time."""
+        future = self._prefetching.get(text)
+        if future is not None:
+            if future.cancel():
+                # It had not started yet, so fetching it here is quicker.
+                del self._prefetching[text]
+            else:
+                speech = future.result()
+                if speech is not None:
+                    return speech
+        return Speech(text).prefetch()
+
+    def number_speech(self, num: int) -> Speech:
+        """Return speech for a number, using the pinned audio if available."""
+        if num in self._numbers:
+            return self._numbers[num]
+        return Speech(str(num))
+
+    def action(self, char: str) -> Optional[Callable[[], None]]:
+        """Return the bound method that handles char, if any."""
+        name = self.ACTIONS.get(char)
+        return None if name is None else getattr(self, name)
+
+    def describe(self, char: str) -> Optional[str]:
+        """Return the help text for the button that sends char, if any."""
+        action = self.action(char)
+        return None if action is None else action.__doc__
 
     def listen_stdin(self) -> None:
         """Listen in the main loop and dispatch events."""
         self.flush_stdin(0)
         while True:
             char = self.prompt_stdin()
+            action = self.action(char)
             if char in self.EXIT_KEYS:
                 logging.info("Goodbye.")
                 break
-            elif char in self._actions:
+            elif action is not None:
                 try:
-                    self._actions[char]()
+                    action()
                 except:
                     traceback.print_exc()
                     with self.mute_context() as ctx:
@@ -93,17 +193,86 @@ class Remote:
             # Flush stdin to ignore double presses
             self.flush_stdin(self._flush_seconds)
 
-    def prompt_stdin(self, timeout: float = 0) -> str:
-        logging.info(f"Listening...")
+    def prompt_stdin(self) -> str:
+        """Read a key from stdin."""
+        logging.info("Listening...")
         self._input_char = readkey()
-        logging.info(f"Event: {repr(self._input_char)}")
+        logging.info("Event: %r", self._input_char)
         return self._input_char
 
     def flush_stdin(self, seconds: float):
+        """Discard pending input, such as double presses and repeats of a
+        button that is held.
+
+        Input is drained for at most the given number of seconds, so that a
+        held button still repeats at that rate. It ends early once no input
+        has arrived for FLUSH_QUIET_SECONDS, which is longer than the repeat
+        interval of the remote.
+        """
         self._input_char = None
-        time.sleep(seconds)
+        fd = sys.stdin.fileno()
+        deadline = time.monotonic() + seconds
+        quiet = time.monotonic() + self.FLUSH_QUIET_SECONDS
+        with self.cbreak_stdin():
+            while True:
+                timeout = min(quiet, deadline) - time.monotonic()
+                if timeout <= 0:
+                    break
+                ready, _, _ = select.select([fd], [], [], timeout)
+                if not ready:
+                    break
+                if not os.read(fd, 4096):
+                    break
+                quiet = time.monotonic() + self.FLUSH_QUIET_SECONDS
         tcflush(sys.stdin, TCIOFLUSH)
 
+    def prompt_during(self, player: subprocess.Popen) -> str:
+        """Wait for a key while player is speaking, then stop the player.
+
+        Playback and stdin are polled together, so we know whether the player
+        is still running when a key arrives.
+        """
+        with self.cbreak_stdin():
+            while player.poll() is None:
+                if self._wait_stdin(self.POLL_SECONDS):
+                    break
+        char = self.prompt_stdin()
+        self.stop_player(player)
+        return char
+
+    def stop_player(self, player: subprocess.Popen) -> None:
+        """Stop player if it is still speaking and reap it."""
+        if player.poll() is None:
+            # Speech players are disposable, so they get no grace period.
+            logging.info("Kill process: %s", player.pid)
+            player.kill()
+        player.wait()
+
+    def _wait_stdin(self, timeout: float) -> bool:
+        """Wait up to timeout seconds for input; stdin must be in cbreak mode."""
+        ready, _, _ = select.select([sys.stdin], [], [], timeout)
+        if not ready:
+            return False
+        # readkey() flushes the terminal input queue before reading, so move
+        # the pending input into Python's buffer first.
+        sys.stdin.buffer.peek(1)
+        return True
+
+    @contextmanager
+    def cbreak_stdin(self):
+        """Put the terminal into cbreak mode, so that select() sees single key
+        presses instead of waiting for a complete line."""
+        fd = sys.stdin.fileno()
+        if not os.isatty(fd):
+            yield
+            return
+        attrs = tcgetattr(fd)
+        try:
+            setcbreak(fd)
+            yield
+        finally:
+            tcsetattr(fd, TCSADRAIN, attrs)
+
     def flush_stdout(self):
         sys.stderr.flush()
         sys.stdout.flush()
@@ -115,19 +284,15 @@ class Remote:
         player = ctx.say_async("Press a button for help.")
         while True:
             self.flush_stdin(self._flush_seconds)
-            char = self.prompt_stdin()
-
-            logging.info(f"Kill process: {player.pid}")
-            player.terminate()
-            player.wait()
+            char = self.prompt_during(player)
 
             if char in self.BACK_KEYS:
                 ctx.say("Back.")
                 break
-            if char in self._actions:
-                action = self._actions[char]
-                if action.__doc__:
-                    player = ctx.say_async(action.__doc__)
+            if char in self.ACTIONS:
+                doc = self.describe(char)
+                if doc:
+                    player = ctx.say_async(doc)
                 else:
                     player = ctx.say_async("Sorry, this button is undocumented.")
             else:
@@ -148,22 +313,26 @@ class Remote:
         if title is not None:
             ctx.say(title)
 
-        def say_entry(index):
-            ctx.say(f"{index+1}")
+        def entry_text(index):
             entry = menu[index][0]
             if type(entry) is not str:
                 entry = entry(ctx)
-            return ctx.say_async(entry)
+            # Announce number and entry as one phrase, so that it is
+            # synthesized and played in one go.
+            return f"{index+1}. {entry}"
+
+        def say_entry(index):
+            player = self.prefetched(entry_text(index)).play_async()
+            # Prepare the neighbouring entries while the user is listening.
+            for other in {(index + 1) % len(menu), (index - 1) % len(menu)}:
+                self.prefetch_async(entry_text(other))
+            return player
 
         index = 0
         while True:
             player = say_entry(index)
             self.flush_stdin(self._flush_seconds)
-            char = self.prompt_stdin()
-
-            logging.info(f"Kill process: {player.pid}")
-            player.terminate()
-            player.wait()
+            char = self.prompt_during(player)
 
             if char in self.PREV_KEYS:
                 ctx.say("Back.")
@@ -185,4 +354,4 @@ class Remote:
                 ctx.say("Use directional buttons.")
 
     def _unbound(self, char: str):
-        logging.info(f"Unbound: {char}")
+        logging.info("Unbound: %s", char)
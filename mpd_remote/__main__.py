@@ -50,6 +50,7 @@ def main(
 
     # Set context object
     ctx.obj = Client(host, port)
+    ctx.call_on_close(ctx.obj.close)
 
 
 @main.command("check")
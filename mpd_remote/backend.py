@@ -2,11 +2,12 @@
 Wrapper around an MPD client that uses types from the library module.
 """
 
-import time
+import functools
+import logging
 import random
 
 from contextlib import contextmanager
-from typing import List, Dict, Tuple
+from typing import List, Dict, Optional, Tuple
 
 import mpd
 
@@ -14,11 +15,21 @@ from .library import Library, Album, Track
 
 
 def with_api(func):
-    """Decorate a method to use the client() context manager."""
+    """Decorate a method to use the client() context manager.
 
-    def wrapper(*args):
-        with args[0].client() as api:
-            return func(args[0], api, *args[1:])
+    MPD drops connections that have been idle for a while, so a call that
+    fails because the connection was lost is retried once on a new one.
+    """
+
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        try:
+            with self.client() as api:
+                return func(self, api, *args, **kwargs)
+        except (mpd.ConnectionError, OSError) as err:
+            logging.debug("Lost connection to MPD, reconnecting: %s", err)
+        with self.client() as api:
+            return func(self, api, *args, **kwargs)
 
     return wrapper
 
@@ -30,20 +41,54 @@ class Client:
         self._client = mpd.MPDClient()
         self._host = host
         self._port = port
+        self._connected = False
 
         with self.client() as api:
-            self._data = api.listallinfo()
-            self.library = Library(self._data)
+            self.library = self._load_library(api)
 
     @contextmanager
     def client(self):
-        """Return a raw connection to MPD as a context manager."""
-        try:
+        """Return a raw connection to MPD as a context manager.
+
+        The connection is opened on first use and kept open afterwards, so
+        that each call does not pay for a new TCP and MPD handshake.
+        """
+        if not self._connected:
             self._client.connect(self._host, self._port)
+            self._connected = True
+        try:
             yield self._client
-        finally:
+        except (mpd.ConnectionError, OSError):
+            self.close()
+            raise
+
+    def close(self):
+        """Close the connection to MPD, if it is open."""
+        if not self._connected:
+            return
+        self._connected = False
+        try:
             self._client.close()
-            self._client.disconnect()
+        except (mpd.ConnectionError, OSError):
+            pass
+        self._client.disconnect()
+
+    def _load_library(self, api, previous: Optional[Library] = None) -> Library:
+        """Build the library while the listing is still being received.
+
+        Iterating avoids holding the whole response in memory in addition to
+        the library built from it.
+        """
+        api.iterate = True
+        try:
+            return Library(api.listallinfo(), previous=previous)
+        except BaseException:
+            # The rest of the response has not been read, so the connection
+            # cannot be used for further commands.
+            self.close()
+            raise
+        finally:
+            api.iterate = False
 
     @with_api
     def genres(self, api) -> List[str]:
@@ -87,8 +132,11 @@ class Client:
         #       'time': '154:216',
         #       'volume': '100',
         #     }
-        status = api.status()
-        playlist = api.playlistinfo()
+        # Fetch both in a single round-trip.
+        api.command_list_ok_begin()
+        api.status()
+        api.playlistinfo()
+        status, playlist = api.command_list_end()
         return status, [Track(x) for x in playlist]
 
     @with_api
@@ -99,25 +147,26 @@ class Client:
     @with_api
     def play_random(self, api, genres: List[str] = None):
         album = self.library.random_album(genres)
-        api.clear()
-        for file in album.files:
-            api.add(str(file))
-        api.play()
+        self._play(api, album)
 
     @with_api
     def play_recent(self, api, limit: int = 100):
         album = random.choice(self.library.recent_albums(limit))
-        api.clear()
-        for file in album.files:
-            api.add(str(file))
-        api.play()
+        self._play(api, album)
 
     @with_api
     def play_album(self, api, album: Album):
+        self._play(api, album)
+
+    @staticmethod
+    def _play(api, album: Album):
+        """Replace the queue with album and play it, in a single round-trip."""
+        api.command_list_ok_begin()
         api.clear()
-        for file in album.files:
-            api.add(str(file))
+        for uri in album.uris:
+            api.add(uri)
         api.play()
+        api.command_list_end()
 
     @with_api
     def play(self, api):
@@ -166,10 +215,12 @@ class Client:
     @with_api
     def update(self, api):
         api.update()
+        # Let MPD tell us when the update has finished instead of polling.
+        # Idle events are queued for the connection, so checking the status
+        # before each wait cannot miss the end of the update.
         while "updating_db" in api.status():
-            time.sleep(0.5)
-        data = api.listallinfo()
-        self.library = Library(data)
+            api.idle("update")
+        self.library = self._load_library(api, previous=self.library)
 
     @with_api
     def toggle(self, api, key, value):
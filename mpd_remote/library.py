@@ -2,16 +2,46 @@
 Internal representations of the the music library and its components.
 """
 
+import bisect
+import heapq
+import itertools
 import random
+import re
 import logging
+import posixpath
+import sys
 
+from collections import defaultdict
 from pathlib import Path
-from typing import List, Dict, Union, Tuple, Set
+from typing import (
+    List,
+    Dict,
+    DefaultDict,
+    FrozenSet,
+    Optional,
+    Union,
+    Tuple,
+    Iterable,
+    Iterator,
+)
 
 from . import vanity
 
 
 class Track:
+    __slots__ = (
+        "title",
+        "artist",
+        "albumartist",
+        "album",
+        "date",
+        "duration",
+        "genres",
+        "file",
+        "suffix",
+        "last_modified",
+    )
+
     def __init__(self, data: Dict[str, str]):
         """
         Data looks like:
@@ -32,49 +62,33 @@ class Track:
             'id': '1'
         }
         """
-        self.data = data
-
-    @property
-    def title(self) -> str:
-        return self.data["title"]
-
-    @property
-    def artist(self) -> Union[str, List[str]]:
-        return self.data["artist"]
-
-    @property
-    def albumartist(self) -> str:
-        return self.data["albumartist"]
-
-    @property
-    def album(self) -> str:
-        return self.data["album"]
-
-    @property
-    def date(self) -> str:
-        return self.data["date"]
-
-    @property
-    def duration(self) -> float:
-        return float(self.data["duration"])
-
-    @property
-    def genres(self) -> List[str]:
-        if "genre" not in self.data:
-            return []
-        gnre = self.data["genre"]
-        if isinstance(gnre, str):
-            return [gnre]
+        # Fields are parsed once, and the data itself is not kept, as there
+        # is one track object for every file in the library.
+        # The file is kept as the URI string MPD uses; a Path is only created
+        # on request, since most code never needs one.
+        self.file: str = data["file"]
+        self.suffix: str = posixpath.splitext(self.file)[1]
+        self.title: str = data.get("title") or _stem(self.file)
+        # Names and genres repeat across many tracks; interning them shares one
+        # string per value and lets comparisons succeed on identity.
+        self.artist: Union[str, List[str]] = _intern(data.get("artist", ""))
+        self.albumartist: str = _intern(data.get("albumartist", self.artist))
+        self.album: str = _intern(data.get("album", ""))
+        self.date: str = data.get("date", "")
+        self.duration: float = float(data.get("duration", 0))
+        self.last_modified: str = data.get("last-modified", "")
+
+        gnre = data.get("genre")
+        if gnre is None:
+            self.genres: Tuple[str, ...] = ()
+        elif isinstance(gnre, str):
+            self.genres = (sys.intern(gnre),)
         else:
-            return gnre
+            self.genres = tuple(sys.intern(g) for g in gnre)
 
     @property
     def path(self) -> Path:
-        return Path(self.data["file"])
-
-    @property
-    def last_modified(self) -> str:
-        return self.data["last-modified"]
+        return Path(self.file)
 
 
 class Album:
@@ -83,52 +97,67 @@ class Album:
         self.artist = tracks[0].albumartist
         self.title = tracks[0].album
         self.date = tracks[0].date
-        self.duration = sum([x.duration for x in tracks])
+        self.duration = sum(x.duration for x in tracks)
+
+        # Albums do not change after creation, so derived values are computed
+        # once here instead of walking the tracks on every access.
+        self._genres = frozenset(g for x in tracks for g in x.genres)
+        self.key: str = _dirname(tracks[0].file)
+        self._uris = tuple(x.file for x in tracks)
+        self._newest_modified = max(x.last_modified for x in tracks)
+        self._oldest_modified = min(x.last_modified for x in tracks)
 
     def has_genre(self, genre: str) -> bool:
-        for trck in self.tracks:
-            if genre in trck.genres:
-                return True
-        return False
+        return genre in self._genres
 
     def is_multi_capable(self) -> bool:
         """Return True if all tracks are capable of storing multiple tag values."""
         for trck in self.tracks:
-            if trck.path.suffix in [".mp3", ".m4a", ".mp4"]:
+            if trck.suffix in (".mp3", ".m4a", ".mp4"):
                 return False
         return True
 
     @property
-    def genres(self) -> Set[str]:
-        genres: Set[str] = set()
-        for trck in self.tracks:
-            for gnre in trck.genres:
-                genres.add(gnre)
-        return genres
+    def genres(self) -> FrozenSet[str]:
+        return self._genres
 
     @property
     def path(self) -> Path:
-        return self.tracks[0].path.parent
+        return Path(self.key)
+
+    @property
+    def files(self) -> Tuple[Path, ...]:
+        return tuple(Path(x) for x in self._uris)
 
     @property
-    def files(self) -> List[Path]:
-        return [x.path for x in self.tracks]
+    def uris(self) -> Tuple[str, ...]:
+        """Files as MPD URIs, i.e. relative to the music directory."""
+        return self._uris
 
     @property
     def newest_modified(self) -> str:
-        return max([x.last_modified for x in self.tracks])
+        return self._newest_modified
 
     @property
     def oldest_modified(self) -> str:
-        return min([x.last_modified for x in self.tracks])
+        return self._oldest_modified
 
 
 class Library:
-    def __init__(self, data: List[Dict[str, str]]):
+    def __init__(
+        self, data: Iterable[Dict[str, str]], previous: Optional["Library"] = None
+    ):
+        """Build the library from the output of listallinfo.
+
+        If previous is given, tracks and albums that have not changed since
+        it was built are reused instead of being parsed again.
+        """
         self.errors = 0
         self.warnings = 0
+        self._tracks: Dict[str, Track] = dict()
 
-        lib: Dict[str, Dict[str, List[Track]]] = dict()
+        # Tracks are grouped by album artist and album in a single flat dict.
+        groups: DefaultDict[Tuple[str, str], List[Track]] = defaultdict(list)
         for item in data:
             # Skip playlists and directories for now
             if "file" not in item:
@@ -138,38 +167,57 @@ class Library:
             if ("albumartist" not in item and "artist" not in item) or (
                 "album" not in item
             ):
-                logging.error(f"Track missing artist or album: {item}")
+                logging.error("Track missing artist or album: %s", item)
                 self.errors += 1
                 continue
 
             # Print warnings for missing metadata:
             if "genre" not in item:
-                logging.debug(f"Track missing genres: {item}")
+                logging.debug("Track missing genres: %s", item)
                 self.warnings += 1
             if "albumartist" not in item:
-                logging.debug(f"Track missing album-artist: {item}")
+                logging.debug("Track missing album-artist: %s", item)
                 self.warnings += 1
                 item["albumartist"] = item["artist"]
 
-            art = item["albumartist"]
-            alb = item["album"]
-            if art not in lib:
-                lib[art] = dict()
-            if alb not in lib[art]:
-                lib[art][alb] = list()
-            lib[art][alb].append(Track(item))
+            file = item["file"]
+            track = None if previous is None else previous._tracks.get(file)
+            if track is None or track.last_modified != item.get("last-modified", ""):
+                track = Track(item)
+            self._tracks[file] = track
+            groups[(track.albumartist, track.album)].append(track)
 
-        self.data = data
         self.albums: Dict[str, Album] = dict()
         self.artists: Dict[str, Dict[str, Album]] = dict()
-        for art in lib.keys():
-            self.artists[art] = dict()
-            for alb in lib[art].keys():
-                trcks = lib[art][alb]
-                self._check_tracks(trcks)
+        for (art, alb), trcks in groups.items():
+            self._check_tracks(trcks)
+            album = None if previous is None else previous.album(art, alb)
+            if album is None or not _same_tracks(album.tracks, trcks):
                 album = Album(trcks)
-                self.artists[art][alb] = album
-                self.albums[str(album.path)] = album
+            self.artists.setdefault(art, dict())[alb] = album
+            self.albums[album.key] = album
+
+        # Index albums by genre, so that genre queries need not scan all tracks.
+        self._by_genre: Dict[str, List[Album]] = dict()
+        for album in self.albums.values():
+            for gnre in album.genres:
+                self._by_genre.setdefault(gnre, []).append(album)
+
+        # All album keys joined into one text with a key per line, so that a
+        # search runs through the regular expression engine in one go.
+        self._keys: List[str] = list(self.albums.keys())
+        self._offsets: List[int] = list()
+        offset = 0
+        for key in self._keys:
+            self._offsets.append(offset)
+            offset += len(key) + 1
+        self._corpus = "\n".join(self._keys)
+        self._recent: Dict[int, List[Album]] = dict()
+        self._album_list: Tuple[Album, ...] = tuple(self.albums.values())
+
+    def album(self, artist: str, title: str) -> Optional[Album]:
+        """Return the album with the given album artist and title, if any."""
+        return self.artists.get(artist, {}).get(title)
 
     def _check_tracks(self, tracks):
         try:
@@ -180,35 +228,83 @@ class Library:
                     trck.albumartist == expect.albumartist
                 ), "album artist inconsistent"
                 assert trck.album == expect.album, "album inconsistent"
-                assert trck.path.parent == expect.path.parent, "directory inconsistent"
+                assert _dirname(trck.file) == _dirname(
+                    expect.file
+                ), "directory inconsistent"
         except AssertionError as err:
-            logging.error(f"Malformed album '{tracks[0].album}': {err}")
+            logging.error("Malformed album '%s': %s", tracks[0].album, err)
             self.errors += 1
 
     def albums_with_genres(self, genres: List[str]) -> List[Album]:
-        result: List[Album] = list()
-        for album in self.albums.values():
-            ags = album.genres
-            for want in genres:
-                if want in ags:
-                    result.append(album)
-        return result
+        # Albums compare by identity, so dict.fromkeys drops albums that have
+        # several of the genres while keeping the order.
+        found = (self._by_genre.get(want, ()) for want in genres)
+        return list(dict.fromkeys(itertools.chain.from_iterable(found)))
 
     def random_album(self, genres: List[str] = None) -> Album:
-        if genres is not None:
-            albums = self.albums_with_genres(genres)
-            return random.choice(albums)
-        return random.choice(list(self.albums.values()))
+        if genres is None:
+            return random.choice(self._album_list)
+        if len(genres) == 1:
+            # The index already holds the albums of a single genre.
+            return random.choice(self._by_genre.get(genres[0], ()))
+        return random.choice(self.albums_with_genres(genres))
 
     def recent_albums(self, limit: int = 100) -> List[Album]:
-        albums = list(self.albums.values())
-        albums.sort(key=lambda x: x.newest_modified)
-        return albums[:limit]
+        """Return the limit most recently modified albums, newest first."""
+        # The library is rebuilt rather than modified on update, so the
+        # result can be kept for as long as this library is in use.
+        if limit not in self._recent:
+            self._recent[limit] = heapq.nlargest(
+                limit, self.albums.values(), key=lambda x: x.newest_modified
+            )
+        return self._recent[limit]
+
+    def iter_album_paths(self) -> Iterator[str]:
+        """Yield the path of each album, as used for the keys of albums."""
+        yield from self.albums.keys()
 
     def search_vanity(self, numbers: str, mode: str = "linear"):
-        regex = vanity.to_regex(numbers, mode)
-        logging.info(f"Searching regex: {regex}")
-        for key in self.albums.keys():
-            if regex.search(key):
-                logging.info(f"Search found: {key}")
-                yield self.albums[key]
+        # Patterns never match a newline, so each match lies within one key.
+        regex = vanity.to_regex(numbers, mode, re.MULTILINE)
+        logging.info("Searching regex: %s", regex.pattern)
+        # A single pass over the corpus: RE2 converts the whole text to UTF-8
+        # on every call, so searching again from each key would be quadratic.
+        last = -1
+        for match in regex.finditer(self._corpus):
+            index = bisect.bisect_right(self._offsets, match.start()) - 1
+            # Each album is yielded only once, even if it matches repeatedly.
+            if index == last:
+                continue
+            last = index
+            key = self._keys[index]
+            logging.debug("Search found: %s", key)
+            yield self.albums[key]
+
+    def search_vanity_incremental(
+        self, results: List[Album], numbers: str, mode: str = "linear"
+    ) -> List[Album]:
+        """Search only within results, which must be the complete results for a
+        prefix of numbers that vanity.narrows() down to numbers."""
+        regex = vanity.to_regex(numbers, mode, re.MULTILINE)
+        logging.info("Filtering %s results with regex: %s", len(results), regex.pattern)
+        return [album for album in results if regex.search(album.key)]
+
+
+def _intern(value):
+    """Intern value if it is a single string; MPD returns lists for repeated tags."""
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+def _dirname(file: str) -> str:
+    """Return the directory of an MPD URI, like Path(file).parent would."""
+    return posixpath.dirname(file) or "."
+
+
+def _stem(file: str) -> str:
+    """Return the file name of an MPD URI without suffix, like Path.stem."""
+    return posixpath.splitext(posixpath.basename(file))[0]
+
+
+def _same_tracks(a: List[Track], b: List[Track]) -> bool:
+    """Return True if both lists hold the very same track objects."""
+    return len(a) == len(b) and all(x is y for x, y in zip(a, b))
@@ -1,86 +1,97 @@
+import os
+import re
 import sys
-import subprocess
 import tempfile
-from typing import Union, List, Dict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Callable, List, Dict, FrozenSet, Optional, Tuple
 from pathlib import Path
 
-import yaml
+import click
 import mutagen
 from mutagen import id3
 
 from .library import Album
 
+# An editable line is an album key, followed by = or : and its genres.
+# The key is taken up to the last delimiter, since album paths may contain
+# either character.
+_LINE_RE = re.compile(r"^\s*(.*\S)\s*([:=])([^:=]*)$")
 
+
+@dataclass
 class Editable:
+    __slots__ = ("key", "genres", "multi")
+
+    key: str
+    genres: FrozenSet[str]
+    multi: bool
+
     genre_sep = ", "
 
-    def __init__(self, album: Union[Album, str]):
-        if isinstance(album, Album):
-            self.key = str(album.path)
-            self.genres = album.genres
-            self.multi = album.is_multi_capable()
-        else:
-            self.multi = album.rfind(":") != -1
-            key, _, genres = album.rpartition(self.delim)
-            self.key = key.strip()
-            if self.key == "":
-                print(f"Error parsing: {album}")
-                raise RuntimeError("cannot parse album-genre data from line")
-            self.genres = {
-                g.strip()
-                for g in genres.split(self.genre_sep.strip())
-                if g.strip() != ""
-            }
+    @classmethod
+    def from_album(cls, album: Album) -> "Editable":
+        return cls(album.key, frozenset(album.genres), album.is_multi_capable())
+
+    @classmethod
+    def from_line(cls, line: str) -> "Editable":
+        match = _LINE_RE.match(line)
+        if match is None:
+            print(f"Error parsing: {line}")
+            raise RuntimeError("cannot parse album-genre data from line")
+        key, delim, genres = match.groups()
+        sep = cls.genre_sep.strip()
+        genre_set = frozenset(g.strip() for g in genres.split(sep) if g.strip() != "")
+        return cls(key, genre_set, delim == ":")
 
     @property
     def delim(self) -> str:
         return ":" if self.multi else "="
 
+    def render(self, padding: int) -> str:
+        return f"{self.key:{padding}} {self.delim} {self.genre_sep.join(self.genres)}\n"
+
     def print(self, padding: int, file=None):
         if file is None:
             file = sys.stdout
-        file.write(
-            "{0:{1}} {3} {2}\n".format(
-                self.key,
-                padding,
-                self.genre_sep.join(self.genres),
-                "=" if not self.multi else ":",
-            )
-        )
+        file.write(self.render(padding))
 
 
 class EditableDatabase:
     def __init__(self, albums: Dict[str, Album]):
         self.delimiter = ", "
-        self.albums: Dict[str, Album] = albums
-        self.database: Dict[str, Editable] = {
-            key: Editable(album) for key, album in albums.items()
+        # Each editable state is kept together with the album it came from.
+        self.database: Dict[str, Tuple[Editable, Album]] = {
+            key: (Editable.from_album(album), album) for key, album in albums.items()
         }
-        self.padding: int = max([len(x) for x in self.database])
+        self.padding: int = max(map(len, self.database), default=0)
+
+        # Albums by genre, with the largest genres first.
+        self._grouped: Dict[str, List[Editable]] = dict()
+        for alb, _ in self.database.values():
+            for genre in alb.genres:
+                self._grouped.setdefault(genre, []).append(alb)
+        self._genre_order: List[str] = sorted(
+            self._grouped, key=lambda x: len(self._grouped[x]), reverse=True
+        )
 
     def print_genres(self, file=None, group: bool = False):
         if file is None:
             file = sys.stdout
         if group:
             return self.print_genres_grouped(file)
-        for _, alb in self.database.items():
-            alb.print(self.padding, file=file)
+        file.write(self.render_genres())
+
+    def render_genres(self) -> str:
+        return "".join(alb.render(self.padding) for alb, _ in self.database.values())
 
     def print_genres_grouped(self, file=None):
         if file is None:
             file = sys.stdout
-        grouped: Dict[str, Album] = dict()
-        for _, alb in self.database.items():
-            for genre in alb.genres:
-                if genre not in grouped:
-                    grouped[genre] = list()
-                grouped[genre].append(alb)
-
-        print("# vim: set ft=yaml fdm=marker:")
-        print("---")
-        genres = sorted(grouped, key=lambda x: len(grouped[x]), reverse=True)
-        for genre in genres:
-            albums = grouped[genre]
+        print("# vim: set ft=yaml fdm=marker:", file=file)
+        print("---", file=file)
+        for genre in self._genre_order:
+            albums = self._grouped[genre]
             genre_total = f" # {len(albums)} {{{{{{1"
             print(
                 "\n{:{}}{}".format(
@@ -105,46 +116,36 @@ class EditableDatabase:
         if item.key not in self.database:
             print(f"Error: cannot match album: {item.key}")
             return False
-        original = self.database[item.key]
-        if original.genres != item.genres:
+        original, album = self.database[item.key]
+        # Genres are frozensets, which cache their hash, so differing hashes
+        # tell changed albums apart without comparing the sets element-wise.
+        old, new = original.genres, item.genres
+        if hash(old) != hash(new) or old != new:
             diff = "[{}] -> [{}]".format(
                 self.delimiter.join(original.genres),
                 self.delimiter.join(item.genres),
             )
             print(f"Update: {item.key} from {diff}")
-            album = self.albums[item.key]
-            for trck in album.tracks:
-                filepath = library_dir / trck.path
+            genres = list(item.genres)
+
+            def update(filepath: Path) -> str:
                 if not filepath.exists():
-                    print(f"- error: file does not exist: {filepath}")
-                print(f"- update: {filepath}")
+                    return f"- error: file does not exist: {filepath}"
                 try:
-                    self._update_genres(filepath, list(item.genres))
+                    if not _update_genres(filepath, genres):
+                        return f"- unchanged: {filepath}"
                 except RuntimeError as err:
-                    print(f"- error: {err}")
+                    return f"- update: {filepath}\n- error: {err}"
+                return f"- update: {filepath}"
+
+            # Tag writes are bound by disk I/O, so tracks are written in parallel.
+            filepaths = [library_dir / trck.file for trck in album.tracks]
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                for result in executor.map(update, filepaths):
+                    print(result)
             return True
         return False
 
-    def _update_genres(self, filepath: Path, genres: List[str]):
-        if filepath.suffix == ".flac":
-            audio = mutagen.File(filepath)
-            audio["GENRE"] = genres
-            audio.save()
-        elif filepath.suffix == ".m4a":
-            if len(genres) > 1:
-                raise RuntimeError(f"cannot set multiple genres for: {filepath}")
-            audio = mutagen.File(filepath)
-            audio["\xa9gen"] = genres[0]
-            audio.save()
-        elif filepath.suffix == ".mp3":
-            if len(genres) > 1:
-                raise RuntimeError(f"cannot set multiple genres for: {filepath}")
-            tags = mutagen.id3.ID3(filepath)
-            tags.add(mutagen.id3.TCON(encoding=3, text=genres[0]))
-            tags.save(filepath)
-        else:
-            raise RuntimeError(f"cannot set genre for: {filepath}")
-
     def edit_genres(self, library: Path, editor: str, group: bool = False):
         assert library.is_dir()
         from_editor: List[Editable] = list()
@@ -156,27 +157,28 @@ class EditableDatabase:
             tmpfile.close()
 
             # Let user modify file:
-            subprocess.run([editor, tmpfile.name], check=True)
+            click.edit(filename=tmpfile.name, editor=editor)
             return
         else:
             # Write editable state to file:
             tmpfile = tempfile.NamedTemporaryFile(mode="w", suffix=".txt", delete=False)
-            for _, alb in self.database.items():
-                alb.print(self.padding, file=tmpfile)
+            tmpfile.write(self.render_genres())
             tmpfile.close()
 
-            # Let user modify file:
-            subprocess.run([editor, tmpfile.name], check=True)
+            # Let user modify file, and skip the comparison if it was not saved:
+            if not _edit_file(tmpfile.name, editor):
+                print("File not saved, nothing to update.")
+                return 0
 
             # Read changes from file:
             with open(tmpfile.name, "r") as file:
-                change_data = file.read()
-            for line in change_data.splitlines():
-                if line.startswith("#"):
-                    continue
-                if line.strip() == "":
-                    continue
-                from_editor.append(Editable(line))
+                for line in file:
+                    line = line.rstrip("\n")
+                    if line.startswith("#"):
+                        continue
+                    if line.strip() == "":
+                        continue
+                    from_editor.append(Editable.from_line(line))
 
         # Apply changes:
         modified = 0
@@ -184,3 +186,59 @@ class EditableDatabase:
             if self._update_album(item, library_dir=library):
                 modified += 1
         return modified
+
+
+def _edit_file(filename: str, editor: Optional[str]) -> bool:
+    """Open filename in editor and return True if the file was saved."""
+    before = os.stat(filename).st_mtime_ns
+    click.edit(filename=filename, editor=editor)
+    return os.stat(filename).st_mtime_ns != before
+
+
+def _write_flac(filepath: Path, genres: List[str]) -> bool:
+    audio = mutagen.File(filepath)
+    if set(audio.get("GENRE", [])) == set(genres):
+        return False
+    audio["GENRE"] = genres
+    audio.save()
+    return True
+
+
+def _write_m4a(filepath: Path, genres: List[str]) -> bool:
+    if len(genres) > 1:
+        raise RuntimeError(f"cannot set multiple genres for: {filepath}")
+    audio = mutagen.File(filepath)
+    if audio.get("\xa9gen") == genres:
+        return False
+    audio["\xa9gen"] = genres[0]
+    audio.save()
+    return True
+
+
+def _write_mp3(filepath: Path, genres: List[str]) -> bool:
+    if len(genres) > 1:
+        raise RuntimeError(f"cannot set multiple genres for: {filepath}")
+    tags = mutagen.id3.ID3(filepath)
+    frame = tags.get("TCON")
+    if frame is not None and frame.text == genres:
+        return False
+    tags.add(mutagen.id3.TCON(encoding=3, text=genres[0]))
+    tags.save(filepath)
+    return True
+
+
+# Genre tag writers by file suffix. Each returns False if the file already
+# had the genres, in which case it is not written.
+_WRITERS: Dict[str, Callable[[Path, List[str]], bool]] = {
+    ".flac": _write_flac,
+    ".m4a": _write_m4a,
+    ".mp3": _write_mp3,
+}
+
+
+def _update_genres(filepath: Path, genres: List[str]) -> bool:
+    try:
+        write = _WRITERS[filepath.suffix]
+    except KeyError:
+        raise RuntimeError(f"cannot set genre for: {filepath}") from None
+    return write(filepath, genres)
@@ -1,11 +1,20 @@
-from typing import Callable, Optional, List, Set
+from typing import Dict, Optional, List, Set
+import itertools
 import logging
 import subprocess
+import threading
+from collections import Counter
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
+from functools import partial, partialmethod
 from pathlib import Path
 
 from readchar import key
-import appdirs
-import yaml
 
 from . import Remote, MuteContext, vanity
 from .backend import Client
@@ -13,7 +22,85 @@ from .library import Album
 from .speech import Speech, Beep, conjoin
 
 
+# Spoken names of playback option states, and the state each toggles to.
+_BINARY_INFO = {"0": "off", "1": "on"}
+_BINARY_TOGGLE = {"0": "1", "1": "0"}
+_SINGLE_INFO = {"0": "off", "1": "on", "oneshot": "one shot"}
+_SINGLE_TOGGLE = {"0": "1", "1": "oneshot", "oneshot": "0"}
+
+# Keys that edit the vanity query while searching. Only ASCII digits count,
+# where str.isdigit would also accept other Unicode digits.
+_DIGITS = frozenset("0123456789")
+_DELETE_KEYS = frozenset({"l", key.LEFT})
+_EDIT_KEYS = _DELETE_KEYS | {"m"}
+
+# Number of speculative search results that are synthesized ahead of time.
+_SPECULATE_RESULTS = 2
+
+
+def _option_text(key: str, info: Dict[str, str], ctx: MuteContext) -> str:
+    return f"{key}: {info[ctx.status[key]]}"
+
+
+def _option_toggle(key: str, toggle: Dict[str, str], ctx: MuteContext) -> bool:
+    ctx.api.toggle(key, toggle[ctx.status[key]])
+    return True
+
+
 class DenonRC1223(Remote):
+    ACTIONS = {
+        #
+        # System controls:
+        "~": "power",
+        #
+        # Amp controls:
+        "=": "volume",
+        "-": "volume",
+        #
+        # Playback controls:
+        " ": "toggle_playback",
+        "<": "prev",
+        ">": "next",
+        "/": "stop",
+        ",": "seek_rewind",
+        ".": "seek_forward",
+        #
+        # Direction pad:
+        "\r": "enter",
+        "\n": "enter",
+        "b": "back",
+        key.UP: "up",
+        key.LEFT: "left",
+        key.DOWN: "down",
+        key.RIGHT: "right",
+        #
+        # Center remote:
+        "i": "info",
+        "s": "source",
+        "q": "queue",
+        "m": "mode",
+        "t": "setup",
+        #
+        # Number pad:
+        "1": "number_1",
+        "2": "number_2",
+        "3": "number_3",
+        "4": "number_4",
+        "5": "number_5",
+        "6": "number_6",
+        "7": "number_7",
+        "8": "number_8",
+        "9": "number_9",
+        "0": "number_0",
+        "+": "number_plus",
+        #
+        # Lower row:
+        "l": "clear",
+        "r": "random",
+        "p": "repeat",
+        "d": "dimmer",
+    }
+
     def __init__(self, client: Client):
         super().__init__(client)
         self._beep = Beep(hz=300, duration=0.2)
@@ -89,92 +176,48 @@ class DenonRC1223(Remote):
             ],
         }
         self._vanity_idx = 0
-        self._actions = {
-            #
-            # System controls:
-            "~": self.power,
-            #
-            # Amp controls:
-            "=": self.volume,
-            "-": self.volume,
-            #
-            # Playback controls:
-            " ": self.toggle_playback,
-            "<": self.prev,
-            ">": self.next,
-            "/": self.stop,
-            ",": self.seek_rewind,
-            ".": self.seek_forward,
-            #
-            # Direction pad:
-            "\r": self.enter,
-            "\n": self.enter,
-            "b": self.back,
-            key.UP: self.up,
-            key.LEFT: self.left,
-            key.DOWN: self.down,
-            key.RIGHT: self.right,
-            #
-            # Center remote:
-            "i": self.info,
-            "s": self.source,
-            "q": self.queue,
-            "m": self.mode,
-            "t": self.setup,
-            #
-            # Number pad:
-            "1": self.number("1"),
-            "2": self.number("2"),
-            "3": self.number("3"),
-            "4": self.number("4"),
-            "5": self.number("5"),
-            "6": self.number("6"),
-            "7": self.number("7"),
-            "8": self.number("8"),
-            "9": self.number("9"),
-            "0": self.number("0"),
-            "+": self.number_plus,
-            #
-            # Lower row:
-            "l": self.clear,
-            "r": self.random,
-            "p": self.repeat,
-            "d": self.dimmer,
-        }
+        self._search_mode = vanity.MODES[self._vanity_idx]
 
     def load_config(self):
+        # Imported here, as they are only needed once at startup.
+        import appdirs
+        import yaml
+
+        try:
+            from yaml import CSafeLoader as SafeLoader
+        except ImportError:
+            # PyYAML was built without libyaml.
+            from yaml import SafeLoader
+
         filepath = Path(appdirs.user_config_dir("mpd-remote")) / "denon_rc1223.yaml"
         if filepath.is_file():
-            logging.info(f"Loading configuration file: {filepath}")
+            logging.info("Loading configuration file: %s", filepath)
             with filepath.open("r") as file:
-                config = yaml.safe_load(file)
+                config = yaml.load(file, Loader=SafeLoader)
             if "genres" in config:
                 self._genres = config["genres"]
             if "flush_seconds" in config:
                 self._flush_seconds = config["flush_seconds"]
 
     def _button(self, name: str):
-        logging.info(f"Button: {name}")
-
-    def _search_mode(self) -> str:
-        return vanity.MODES[self._vanity_idx]
+        logging.info("Button: %s", name)
 
     def print_genre_groups(self):
         """Print the genre mapping along with how many albums are in each genre."""
         all_genres: List[str] = self._client.genres()
         seen_genres: Set[str] = set()
-        padding = max([len(x) for x in all_genres])
+        padding = max(map(len, all_genres), default=0)
+        row_fmt = f"  + {{:<{padding}}} {{}}"
+        total_fmt = f"  --{{:->{padding}}} {{}}"
 
         def analyze_genres(genres):
-            total: Set[str] = set()
+            total: Set[Album] = set()
             for gnr in genres:
                 albums = self._client.library.albums_with_genres([gnr])
-                num = len(albums)
-                print("  + {:<{}} {}".format(gnr, padding, num))
+                print(row_fmt.format(gnr, len(albums)))
                 seen_genres.add(gnr)
-                for alb in albums:
-                    total.add(alb)
-            print("  --{:->{}} {}".format(">", padding, len(total)))
+                total.update(albums)
+            print(total_fmt.format(">", len(total)))
 
         for gid, genres in self._genres.items():
             print(f"Number {gid}:")
@@ -185,11 +228,10 @@ class DenonRC1223(Remote):
         self.flush_stdout()
 
     def prefetch(self):
-        """Prefetch audio speech segments for reduced waiting times (roughly 30
+        """Prefetch audio speech segments for reduced waiting times (roughly 300
         MB for a large library)."""
-        # Prefetch common terms (these will change from time to time):
-        logging.info("Prefetching: common terms")
-        for text in [
+        # Common terms (these will change from time to time):
+        common = [
             "OK",
             "Back.",
             "Ready.",
@@ -204,28 +246,28 @@ class DenonRC1223(Remote):
             #
             # Power menu: power()
             "Power menu.",
-            "Update library?",
+            "1. Update library?",
             "Updating library.",
-            "Restart system?",
+            "2. Restart system?",
             "Restarting system.",
-            "Shutdown system?",
+            "3. Shutdown system?",
             "Shutting down system.",
             #
             # Setup menu: setup()
             "Setup menu.",
-            "consume: on",
-            "consume: off",
-            "random: on",
-            "random: off",
-            "repeat: on",
-            "repeat: off",
-            "single: on",
-            "single: off",
-            "single: one shot",
-            "replay-gain: off",
-            "replay-gain: auto",
-            "replay-gain: track",
-            "replay-gain: album",
+            "1. consume: on",
+            "1. consume: off",
+            "2. random: on",
+            "2. random: off",
+            "3. repeat: on",
+            "3. repeat: off",
+            "4. single: on",
+            "4. single: off",
+            "4. single: one shot",
+            "5. replay-gain: off",
+            "5. replay-gain: auto",
+            "5. replay-gain: track",
+            "5. replay-gain: album",
             #
             # Information: info(), source(), queue()
             "Currently playing:",
@@ -240,25 +282,48 @@ class DenonRC1223(Remote):
             "search mode: fuzzy",
             "Use vanity numbers to search.",
             "Use numbers and directional buttons.",
-        ]:
-            Speech(text).prefetch()
-
-        # Prefetch help texts:
-        logging.info("Prefetching: help texts")
-        for key in self._actions.keys():
-            action = self._actions[key]
-            if action.__doc__:
-                Speech(action.__doc__).prefetch()
-
-        # Prefetch numbers up to 100:
-        logging.info("Prefetching: numbers")
-        for num in range(100):
-            Speech(f"{num}").prefetch()
-
-        # Prefetch all album paths:
-        logging.info("Prefetching: album paths")
-        for alb in self._client.library.albums.keys():
-            Speech(alb).prefetch()
+        ]
+
+        # Help texts, numbers up to 100, and all album paths:
+        helps = filter(None, map(self.describe, self.ACTIONS))
+        numbers = (f"{num}" for num in range(100))
+        albums = self._client.library.iter_album_paths()
+
+        # Skip duplicates here and cached segments in the workers, so that
+        # checking the cache overlaps with fetching.
+        texts = dict.fromkeys(itertools.chain(common, helps, numbers, albums))
+        logging.info("Prefetching up to %s speech segments", len(texts))
+
+        # Stop at the first failure rather than filling the cache with the
+        # local voice, which would then be used instead of gTTS for good.
+        failed = threading.Event()
+
+        def fetch(text: str) -> bool:
+            speech = Speech(text)
+            if failed.is_set() or speech.cached:
+                return False
+            try:
+                speech.prefetch(retry=True, fallback=False)
+            except Exception:
+                failed.set()
+                raise
+            return True
+
+        # Fetching is bound by network latency, so many requests run in parallel.
+        # Only a few tasks are queued ahead of the workers, so that texts are
+        # turned into tasks as workers become free.
+        fetched = 0
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            pending: Set[Future] = set()
+            for done, text in enumerate(texts, 1):
+                pending.add(executor.submit(fetch, text))
+                if len(pending) >= 32:
+                    finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    fetched += sum(f.result() for f in finished)
+                if done % 100 == 0:
+                    logging.info("Prefetched %s of %s", done, len(texts))
+            fetched += sum(f.result() for f in as_completed(pending))
+        logging.info("Fetched %s new speech segments", fetched)
 
     def power(self):
         """Update, restart or shutdown system."""
@@ -370,45 +435,136 @@ class DenonRC1223(Remote):
 
         play: Optional[Album] = None
 
+        # Bound once, as the loop below runs on every key press.
+        library = self._client.library
+        back_keys = self.BACK_KEYS
+        enter_keys = self.ENTER_KEYS
+
         def toggle_vanity(ctx: MuteContext):
             self._vanity_idx = (self._vanity_idx + 1) % len(vanity.MODES)
-            return ctx.say_async(f"search mode: {self._search_mode()}")
-
-        def extend_results(ctx):
+            self._search_mode = vanity.MODES[self._vanity_idx]
+            # Replaced rather than cleared, so that speculative searches still
+            # running for the previous mode cannot add to the new one.
+            cancel_speculation(ctx)
+            ctx.searches = {}
+            return ctx.say_async(f"search mode: {self._search_mode}")
+
+        def extend_results(ctx) -> bool:
+            """Append the next search result, returning whether there was one."""
             if ctx.generator is None:
-                return
+                return False
             try:
                 item = next(ctx.generator)
             except StopIteration:
-                pass
-            else:
-                ctx.results.append(item)
-                ctx.index += 1
+                ctx.generator = None
+                return False
+            ctx.results.append(item)
+            return True
+
+        def prefetch_next(ctx):
+            # The user is likely to press DOWN next, so look one result ahead
+            # and prepare it while the current result is being spoken.
+            if ctx.index + 1 < len(ctx.results) or extend_results(ctx):
+                self.prefetch_async(ctx.results[ctx.index + 1].key)
 
         def say_current(ctx, say_initial: bool = False):
             if ctx.index >= 0:
                 if ctx.index > 0 or say_initial:
-                    ctx.player = ctx.say_async(f"{ctx.index+1}")
-                result = Speech(str(ctx.results[ctx.index].path)).prefetch()
+                    ctx.player = self.number_speech(ctx.index + 1).play_async()
+                result = self.prefetched(ctx.results[ctx.index].key)
                 ctx.player.wait()
-                return result.play_async()
-            return ctx.say_async("0")
+                player = result.play_async()
+                prefetch_next(ctx)
+                return player
+            return self.number_speech(0).play_async()
+
+        def search(ctx, query: str) -> List[Album]:
+            # Remember the results of each query, so that removing a number
+            # needs no search and adding one only filters the previous results.
+            if query not in ctx.searches:
+                mode = self._search_mode
+                prefix = query[:-1]
+                if (
+                    query
+                    and prefix in ctx.searches
+                    and vanity.narrows(prefix, query[-1], mode)
+                ):
+                    results = library.search_vanity_incremental(
+                        ctx.searches[prefix], query, mode
+                    )
+                else:
+                    results = list(library.search_vanity(query, mode=mode))
+                ctx.searches[query] = results
+            return ctx.searches[query]
+
+        def speculate_one(searches, results, query: str, mode: str) -> Optional[str]:
+            """Search for query and return the key of its first result."""
+            try:
+                found = library.search_vanity_incremental(results, query, mode)
+            except Exception as err:
+                logging.debug("Cannot speculate on %r: %s", query, err)
+                return None
+            searches.setdefault(query, found)
+            return found[0].key if found else None
+
+        def speculate(ctx, query: str):
+            # The next key is most likely another number, so search for each
+            # longer query and prepare its first result while the user listens.
+            results = ctx.searches.get(query)
+            if not results:
+                return
+            mode = self._search_mode
+            for char in sorted(_DIGITS):
+                if vanity.narrows(query, char, mode):
+                    ctx.speculation.append(
+                        self._prefetch_executor.submit(
+                            speculate_one, ctx.searches, results, query + char, mode
+                        )
+                    )
+
+        def collect_speculation(ctx):
+            # Synthesis is started here through prefetch_async rather than in
+            # the workers, so that prefetched() can wait for it instead of
+            # fetching the same text a second time. Only the results that most
+            # numbers lead to are prepared, to keep gTTS requests and the
+            # prefetch queue short.
+            keys = Counter(
+                future.result()
+                for future in ctx.speculation
+                if future.done() and not future.cancelled()
+            )
+            keys.pop(None, None)
+            for key, _ in keys.most_common(_SPECULATE_RESULTS):
+                # Prefetches that were not started here are left alone.
+                if key not in self._prefetching:
+                    self.prefetch_async(key)
+                    ctx.speculated.append(key)
+
+        def cancel_speculation(ctx):
+            for future in ctx.speculation:
+                future.cancel()
+            for text in ctx.speculated:
+                self.cancel_prefetch(text)
+            ctx.speculated = []
+            ctx.speculation = []
 
         def new_search(ctx, query: str):
             ctx.results = []
-            logging.info(f"Searching vanity: {query}")
-            ctx.generator = ctx.api.library.search_vanity(
-                query, mode=self._search_mode()
-            )
-            ctx.index = -1
-            extend_results(ctx)
+            logging.info("Searching vanity: %s", query)
+            ctx.generator = iter(search(ctx, query))
+            ctx.index = 0 if extend_results(ctx) else -1
             if ctx.player:
                 ctx.player.wait()
-            return say_current(ctx)
+            player = say_current(ctx)
+            speculate(ctx, query)
+            return player
 
         with self.mute_context() as ctx:
             # Set up context:
             ctx.generator = None
+            ctx.searches: Dict[str, List[Album]] = {}
+            ctx.speculation: List[Future] = []
+            ctx.speculated: List[str] = []
             ctx.results: List[Album] = []
             ctx.index: int = -1
             ctx.player: subprocess.Popen = ctx.say_async("Search albums.")
@@ -417,17 +573,15 @@ class DenonRC1223(Remote):
             query: str = ""
             while True:
                 self.flush_stdin(self._flush_seconds)
-                char = self.prompt_stdin()
-
-                logging.info(f"Kill process: {ctx.player.pid}")
-                ctx.player.terminate()
-                ctx.player.wait()
+                collect_speculation(ctx)
+                char = self.prompt_during(ctx.player)
+                cancel_speculation(ctx)
 
-                if char in self.BACK_KEYS:
+                if char in back_keys:
                     ctx.say("Back.")
                     break
-                elif (char >= "0" and char <= "9") or char in ["l", "m", key.LEFT]:
-                    if char in ["l", key.LEFT]:
+                elif char in _DIGITS or char in _EDIT_KEYS:
+                    if char in _DELETE_KEYS:
                         query = query[:-1]
                     elif char == "m":
                         ctx.player = toggle_vanity(ctx)
@@ -443,16 +597,14 @@ class DenonRC1223(Remote):
                     else:
                         ctx.player = ctx.say_async("Use vanity numbers to search.")
                 elif char == key.DOWN:
-                    if ctx.index + 1 >= len(ctx.results):
-                        extend_results(ctx)
-                    else:
+                    if ctx.index + 1 < len(ctx.results) or extend_results(ctx):
                         ctx.index += 1
                     ctx.player = say_current(ctx)
                 elif char == key.UP:
                     if ctx.index > 0:
                         ctx.index -= 1
                     ctx.player = say_current(ctx, say_initial=True)
-                elif char in self.ENTER_KEYS:
+                elif char in enter_keys:
                     play = ctx.results[ctx.index]
                     ctx.say("OK")
                     break
@@ -460,7 +612,7 @@ class DenonRC1223(Remote):
                     ctx.player = ctx.say_async("Use numbers and directional buttons.")
 
         if play is not None:
-            logging.info(f"Playing album: {play.path}")
+            logging.info("Playing album: %s", play.key)
             self._client.play_album(play)
 
     def info(self):
@@ -473,11 +625,7 @@ class DenonRC1223(Remote):
             player = ctx.say_async("Currently playing:")
             current = ctx.current()
             assert current is not None
-            target = Speech(f"{current.title} by {current.artist}").prefetch(
-                cache=False
-            )
-            player.wait()
-            target.play()
+            Speech(f"{current.title} by {current.artist}").play_streaming(player)
 
     def source(self):
         """Speak album and artist of current track."""
@@ -502,12 +650,8 @@ class DenonRC1223(Remote):
                 return
             player = ctx.say_async("Current playlist has:")
             tracks = ctx.status["playlistlength"]
-            minutes = round(sum([t.duration for t in ctx.playlist]) / 60)
-            target = Speech(f"{tracks} tracks summing {minutes} minutes.").prefetch(
-                cache=False
-            )
-            player.wait()
-            target.play()
+            minutes = round(sum(t.duration for t in ctx.playlist) / 60)
+            Speech(f"{tracks} tracks summing {minutes} minutes.").play_streaming(player)
 
     def mode(self):
         """Reserved."""
@@ -522,21 +666,31 @@ class DenonRC1223(Remote):
 
         def option(key: str):
             if key == "single":
-                info = {"0": "off", "1": "on", "oneshot": "one shot"}
-                toggle = {"0": "1", "1": "oneshot", "oneshot": "0"}
+                info, toggle = _SINGLE_INFO, _SINGLE_TOGGLE
             else:
-                info = {"0": "off", "1": "on"}
-                toggle = {"0": "1", "1": "0"}
+                info, toggle = _BINARY_INFO, _BINARY_TOGGLE
             return (
-                lambda ctx: f"{key}: {info[ctx.status[key]]}",
-                lambda ctx: ctx.api.toggle(key, toggle[ctx.status[key]]) or True,
+                partial(_option_text, key, info),
+                partial(_option_toggle, key, toggle),
             )
 
         def option_replay_gain():
-            return (
-                lambda ctx: f"replay-gain: {ctx.api.status_replay_gain()}",
-                lambda ctx: ctx.api.toggle_replay_gain() or True,
-            )
+            # Replay gain is not part of the status snapshot in ctx, so query
+            # it once and then track the mode that toggling returns.
+            mode = None
+
+            def text(ctx):
+                nonlocal mode
+                if mode is None:
+                    mode = ctx.api.status_replay_gain()
+                return f"replay-gain: {mode}"
+
+            def toggle(ctx):
+                nonlocal mode
+                mode = ctx.api.toggle_replay_gain()
+                return True
+
+            return text, toggle
 
         with self.mute_context() as ctx:
             self.navigate_menu(
@@ -551,19 +705,30 @@ class DenonRC1223(Remote):
                 title="Setup menu.",
             )
 
-    def number(self, num: str) -> Callable[[], None]:
-        """Create a function to play a random album from a list of genres."""
-        genres = self._genres[num]
-        button = f"{num} {vanity.VANITY_MAP[num]}"
-
-        def func():
-            self._button(button)
-            self._repeat_char = self._input_char
-            self._client.play_random(genres)
-
-        # Set the documentation on the function so that the help function works.
-        func.__doc__ = f"Play {conjoin('or', genres or ['random'])} album."
-        return func
+    def number(self, num: str):
+        """Play a random album from the genres assigned to a number."""
+        self._button(f"{num} {vanity.VANITY_MAP[num]}")
+        self._repeat_char = self._input_char
+        self._client.play_random(self._genres.get(num) or None)
+
+    number_1 = partialmethod(number, "1")
+    number_2 = partialmethod(number, "2")
+    number_3 = partialmethod(number, "3")
+    number_4 = partialmethod(number, "4")
+    number_5 = partialmethod(number, "5")
+    number_6 = partialmethod(number, "6")
+    number_7 = partialmethod(number, "7")
+    number_8 = partialmethod(number, "8")
+    number_9 = partialmethod(number, "9")
+    number_0 = partialmethod(number, "0")
+
+    def describe(self, char: str) -> Optional[str]:
+        # Number buttons are described by the genres assigned to them, which
+        # may change when the configuration is loaded.
+        if self.ACTIONS.get(char) == f"number_{char}":
+            genres = self._genres.get(char)
+            return f"Play {conjoin('or', genres or ['random'])} album."
+        return super().describe(char)
 
     def number_plus(self):
         """Play recent album."""
@@ -579,12 +744,12 @@ class DenonRC1223(Remote):
     def random(self):
         """Play random album."""
         self._button("RANDOM")
-        self._actions["0"]()
+        self.number("0")
 
     def repeat(self):
         """Repeat last number choice."""
         self._button("REPEAT")
-        self._actions[self._repeat_char]()
+        self.action(self._repeat_char)()
 
     def dimmer(self):
         """Reserved."""
@@ -1,40 +1,310 @@
 from __future__ import annotations
 
 import io
+import atexit
+import functools
+import os
 import hashlib
 import logging
+import queue
+import shutil
 import subprocess
+import tempfile
+import threading
+import time
 from pathlib import Path
-from typing import List, Dict, Union, Callable, Optional, Tuple
+from typing import TYPE_CHECKING, List, Dict, Union, Callable, Optional, Set, Tuple
 
-import appdirs
-from gtts import gTTS
+if TYPE_CHECKING:
+    from gtts import gTTS
 
 
-CACHE_DIR = Path(appdirs.user_cache_dir("mpd-remote", None))
+@functools.lru_cache(maxsize=None)
+def _cache_dir() -> Path:
+    """Return the cache directory, importing appdirs only when it is needed."""
+    import appdirs
+
+    return Path(appdirs.user_cache_dir("mpd-remote", None))
+
+
+# Speech synthesis backends: gTTS needs network access, espeak-ng runs locally.
+BACKENDS = ["gtts", "espeak-ng"]
+
+# Seconds to wait before each retry when gTTS answers with 429 Too Many Requests.
+# Only bulk prefetching retries, as nobody is waiting for the speech there.
+_RETRY_DELAYS = (1, 2, 4, 8)
+
+# Seconds to wait for Google before giving up on a request, and for how long
+# gTTS is not tried again after it failed, so that speaking while offline does
+# not wait for the network every time.
+GTTS_TIMEOUT_SECONDS = 5
+GTTS_COOLDOWN_SECONDS = 300
+
+# Executables are resolved once up front. With an absolute path and close_fds
+# disabled, subprocess can use posix_spawn instead of fork and exec, which is
+# considerably cheaper. Python's own file descriptors are not inheritable, so
+# disabling close_fds does not leak them into children.
+PLAY = shutil.which("play") or "play"
+SOX = shutil.which("sox") or "sox"
+ESPEAK = shutil.which("espeak-ng") or "espeak-ng"
+SH = shutil.which("sh") or "/bin/sh"
+# espeak-ng is optional; without it there is nothing to fall back to from gTTS.
+HAVE_ESPEAK = os.path.isabs(ESPEAK)
+
+# Speech is stored and played as raw PCM, so that playback needs no decoder.
+PCM_FORMAT = "-t raw -e signed-integer -b 16 -L -c 1 -r 24000".split()
+
+
+@functools.lru_cache(maxsize=None)
+def _gtts():
+    """Import gtts on first use.
+
+    gtts pulls in requests and its dependencies, which takes a noticeable time
+    to load and is not needed at all as long as every phrase is cached.
+    """
+    import gtts.tts
+
+    return gtts
+
+
+@functools.lru_cache(maxsize=None)
+def _session_gtts() -> type:
+    """Return a gTTS class that reuses one keep-alive session per thread.
+
+    gTTS opens a new session for every request, paying a TCP and TLS handshake
+    each time. Sessions are kept per thread, as requests does not promise that
+    sharing one between threads is safe, and gTTS itself is left untouched for
+    any other user in the process.
+    """
+    import base64
+    import re
+    import urllib.request
+
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    gtts = _gtts()
+    local = threading.local()
+
+    def session() -> requests.Session:
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+            local.session.mount("https://", HTTPAdapter(max_retries=1))
+        return local.session
+
+    class SessionGTTS(gtts.tts.gTTS):
+        def stream(self):
+            # Mirrors gTTS.stream, but sends the requests over session().
+            for idx, request in enumerate(self._prepare_requests()):
+                try:
+                    response = session().send(
+                        request,
+                        proxies=urllib.request.getproxies(),
+                        timeout=self.timeout,
+                    )
+                    response.raise_for_status()
+                except requests.exceptions.HTTPError:
+                    raise gtts.tts.gTTSError(tts=self, response=response)
+                except requests.exceptions.RequestException:
+                    raise gtts.tts.gTTSError(tts=self)
+
+                for line in response.iter_lines(chunk_size=1024):
+                    decoded = line.decode("utf-8")
+                    if "jQ1olc" not in decoded:
+                        continue
+                    audio = re.search(r'jQ1olc","\[\\"(.*)\\"]', decoded)
+                    if audio is None:
+                        # The response has no audio stream.
+                        raise gtts.tts.gTTSError(tts=self, response=response)
+                    yield base64.b64decode(audio.group(1).encode("ascii"))
+
+    return SessionGTTS
+
+
+class _Unavailable(RuntimeError):
+    """Raised when a speech backend cannot be used right now."""
+
+
+_gtts_retry_at = 0.0
+
+
+def _gtts_available() -> bool:
+    """Return False if gTTS failed less than GTTS_COOLDOWN_SECONDS ago."""
+    return time.monotonic() >= _gtts_retry_at
+
+
+def _gtts_failed() -> None:
+    """Stop using gTTS for a while, if espeak-ng can be used instead."""
+    global _gtts_retry_at
+    if HAVE_ESPEAK:
+        _gtts_retry_at = time.monotonic() + GTTS_COOLDOWN_SECONDS
+
+
+class _Standby:
+    """Keep a player process started ahead of time, waiting for audio on stdin.
+
+    Starting a process costs a fork and an exec, which is noticeable on small
+    devices. Taking the spare process removes that from the time between a key
+    press and speech; a new spare is started in the background right away.
+
+    The spare is a shell that only executes the player once it is taken.
+    `play` opens the sound device when it starts, and an idle player holding
+    it would keep MPD from playing on an exclusive output such as ALSA hw.
+    """
+
+    def __init__(self, args: List[str], **kwargs):
+        self.args = args
+        self.kwargs = kwargs
+        self._lock = threading.Lock()
+        self._proc: Optional[subprocess.Popen] = None
+        atexit.register(self.close)
+
+    def _spawn(self) -> subprocess.Popen:
+        # The shell waits for one line on stdin before replacing itself with
+        # the player; read takes no more than that line from a pipe.
+        args = [SH, "-c", 'read -r _ && exec "$@"', "sh", *self.args]
+        return subprocess.Popen(args, stdin=subprocess.PIPE, **self.kwargs)
+
+    def _refill(self) -> None:
+        proc = self._spawn()
+        with self._lock:
+            if self._proc is None:
+                self._proc = proc
+                return
+        # Someone else refilled in the meantime.
+        proc.kill()
+        proc.wait()
+
+    def take(self) -> subprocess.Popen:
+        with self._lock:
+            proc, self._proc = self._proc, None
+        if proc is None or proc.poll() is not None:
+            proc = self._spawn()
+        threading.Thread(target=self._refill, daemon=True).start()
+        proc.stdin.write(b"\n")
+        proc.stdin.flush()
+        return proc
+
+    def close(self) -> None:
+        with self._lock:
+            proc, self._proc = self._proc, None
+        if proc is not None:
+            proc.kill()
+            proc.wait()
+
+
+_PLAYER = _Standby(
+    [PLAY, "-q", *PCM_FORMAT, "-", "delay", "0.1"],
+    stdout=subprocess.PIPE,
+    stderr=subprocess.STDOUT,
+    close_fds=False,
+)
+
+_ASYNC_PLAYER = _Standby(
+    [PLAY, "-q", *PCM_FORMAT, "-", "delay", "0.1"],
+    stdout=subprocess.DEVNULL,
+    stderr=subprocess.DEVNULL,
+    close_fds=False,
+)
+
+
+def _feed(proc: subprocess.Popen, data: bytes) -> None:
+    """Write all data to the stdin of proc and close it."""
+    try:
+        proc.stdin.write(data)
+        proc.stdin.close()
+    except (BrokenPipeError, ValueError):
+        # Playback was terminated before all audio was written.
+        pass
+
+
+@functools.lru_cache(maxsize=1)
+def _cached_hashes(cache_dir: Path) -> Set[str]:
+    """Return the hashes of all cached files, read with a single directory scan.
+
+    This saves a stat call per Speech when checking thousands of texts against
+    the cache. The set is updated whenever a new file is cached.
+    """
+    try:
+        with os.scandir(cache_dir) as entries:
+            return {e.name[:-4] for e in entries if e.name.endswith(".pcm")}
+    except FileNotFoundError:
+        return set()
+
+
+@functools.lru_cache(maxsize=128)
+def _load_audio(path: str) -> bytes:
+    """Read a cached audio file, keeping frequently spoken phrases in memory."""
+    return Path(path).read_bytes()
 
 
 class Speech:
-    def __init__(self, text: str, cache: bool = True):
+    def __init__(
+        self,
+        text: str,
+        cache: bool = True,
+        lang: str = "en",
+        slow: bool = False,
+        backend: str = "gtts",
+    ):
+        if backend not in BACKENDS:
+            raise RuntimeError(f"unknown speech backend: {backend}")
         self.text: str = text
-        self.lang: str = "en"
-        self.hash: str = hashlib.md5(text.encode("utf-8")).hexdigest()
-        self.audio: Optional[io.BytesIO] = None
+        self.lang: str = lang
+        self.slow: bool = slow
+        self.backend: str = backend
+        self.audio: Optional[bytes] = None
         self.cache: bool = cache
+        self._hash: Optional[str] = None
+
+    @property
+    def hash(self) -> str:
+        """Cache key, computed on first use since many instances never need it."""
+        if self._hash is None:
+            # Everything that changes the synthesized audio must be part of the
+            # key, otherwise a cached file from another voice would be played.
+            fields = ["pcm", self.backend, self.lang, str(int(self.slow)), self.text]
+            key = "\x00".join(fields)
+            self._hash = hashlib.blake2b(
+                key.encode("utf-8"), digest_size=16
+            ).hexdigest()
+        return self._hash
 
     @property
     def file(self) -> Path:
-        return self.cache_dir / Path(self.hash + ".mp3")
+        return self.cache_dir / Path(self.hash + ".pcm")
+
+    @property
+    def cached(self) -> bool:
+        """Return True if the audio for this text is in the cache."""
+        hashes = _cached_hashes(self.cache_dir)
+        if self.hash in hashes:
+            return True
+        # The cache may have been filled by another process in the meantime.
+        if self.file.exists():
+            hashes.add(self.hash)
+            return True
+        return False
 
     @property
     def cache_dir(self) -> Path:
-        return CACHE_DIR / Path("tts")
+        return _cache_dir() / Path("tts")
 
     @property
     def gtts(self) -> gTTS:
-        return gTTS(self.text, lang=self.lang)
+        return _session_gtts()(
+            self.text, lang=self.lang, slow=self.slow, timeout=GTTS_TIMEOUT_SECONDS
+        )
+
+    def prefetch(
+        self, cache: bool = None, retry: bool = False, fallback: bool = True
+    ) -> Speech:
+        """Load the audio from the cache or synthesize it.
 
-    def prefetch(self, cache: bool = None) -> Speech:
+        With retry, wait and try again when gTTS is rate limited instead of
+        falling back to espeak-ng right away. Without fallback, raise an error
+        rather than using espeak-ng, for audio that is kept for later.
+        """
         # Fallback to class default if cache is unset
         if cache is None:
             cache = self.cache
@@ -43,50 +313,159 @@ class Speech:
         if self.audio is not None:
             return self
 
-        # Fetch and (maybe) cache speech audio.
-        if self.file.exists():
-            logging.debug(f"Using cache: {self.file}")
-            with self.file.open("rb") as file:
-                self.audio = io.BytesIO(file.read())
+        # Use cached speech audio if there is any.
+        try:
+            self.audio = _load_audio(str(self.file))
+        except FileNotFoundError:
+            pass
         else:
-            logging.debug(f"Fetching audio for: {self.text}")
-            self.audio = io.BytesIO()
-            self.gtts.write_to_fp(self.audio)
-            if cache:
-                if not self.cache_dir.exists():
-                    logging.debug(f"Making directory: {self.cache_dir}")
-                    self.cache_dir.mkdir(parents=True)
-                with self.file.open("wb") as file:
-                    logging.debug(f"Caching audio: {self.file}")
-                    self.gtts.write_to_fp(file)
+            logging.debug("Using cache: %s", self.file)
+            return self
+
+        # While gTTS is known to fail, use the local voice and its cache
+        # without waiting for the network first.
+        if self.backend == "gtts" and not _gtts_available():
+            if not fallback:
+                raise _Unavailable("gTTS failed recently")
+            return self._fallback(cache)
+
+        # Fetch and (maybe) cache speech audio.
+        logging.debug("Fetching audio for: %s", self.text)
+        try:
+            self.audio = self._synthesize(retry)
+        except _Unavailable as err:
+            _gtts_failed()
+            if not (fallback and HAVE_ESPEAK):
+                raise
+            logging.warning("Cannot use gTTS, falling back to espeak-ng: %s", err)
+            return self._fallback(cache)
+        if cache:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            logging.debug("Caching audio: %s", self.file)
+            # Write to a private temporary file first and move it into place,
+            # so that readers never see a partially written cache entry.
+            fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=self.cache_dir)
+            with os.fdopen(fd, "wb") as file:
+                file.write(self.audio)
+            os.replace(tmp, self.file)
+            _cached_hashes(self.cache_dir).add(self.hash)
+
+        return self
 
+    def _fallback(self, cache: bool) -> Speech:
+        """Use the local voice instead of gTTS. Its audio is cached under its
+        own key, so gTTS is tried again once it is available."""
+        fallback = Speech(self.text, self.cache, self.lang, self.slow, "espeak-ng")
+        self.audio = fallback.prefetch(cache).audio
         return self
 
+    def _synthesize(self, retry: bool = False) -> bytes:
+        if self.backend == "gtts":
+            delays = _RETRY_DELAYS if retry else ()
+            for delay in delays + (None,):
+                mp3 = io.BytesIO()
+                try:
+                    self.gtts.write_to_fp(mp3)
+                except ImportError as err:
+                    raise _Unavailable(f"cannot import gtts: {err}") from err
+                except _gtts().gTTSError as err:
+                    # Many prefetch workers can trip the rate limit, which is
+                    # only temporary, so back off and try again.
+                    status = getattr(err.rsp, "status_code", None)
+                    if status != 429 or delay is None:
+                        raise _Unavailable(str(err)) from err
+                    logging.debug("Rate limited, retrying in %ss", delay)
+                    time.sleep(delay)
+                else:
+                    break
+            return _to_pcm(mp3.getvalue(), "mp3")
+        else:
+            wav = _espeak(self.text, self.lang, self.slow)
+            return _to_pcm(wav, "wav")
+
     def play_async(self) -> subprocess.Popen:
         self.prefetch(cache=True)
-        logging.info(f"Speaking: {self.text}")
-        proc = subprocess.Popen(
-            ["play", "-q", str(self.file), "delay", "0.1"],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-        )
-        logging.info(f"Process: {proc.pid}")
+        logging.info("Speaking: %s", self.text)
+        proc = _ASYNC_PLAYER.take()
+        logging.info("Process: %s", proc.pid)
+        # Feed the audio from a thread: the pipe only holds a few seconds of
+        # audio and the caller may terminate playback at any moment.
+        threading.Thread(target=_feed, args=(proc, self.audio), daemon=True).start()
         return proc
 
     def play(self) -> None:
         self.prefetch()
         assert self.audio is not None
-        logging.info(f"Speaking: {self.text}")
+        logging.info("Speaking: %s", self.text)
+        with _PLAYER.take() as proc:
+            stdout, _ = proc.communicate(self.audio)
+            if proc.returncode != 0:
+                raise RuntimeError(f"error running play:\n{stdout.decode()}")
+
+    def play_streaming(self, after: Optional[subprocess.Popen] = None) -> None:
+        """Speak without caching, starting playback before synthesis is done.
+
+        Synthesis starts immediately, while playback waits for the process
+        after to finish, so that a preceding phrase is not cut off. This is
+        meant for one-off phrases such as track titles; cached audio and the
+        offline backend are played as usual.
+        """
+        if self.backend != "gtts" or self.cached or not _gtts_available():
+            self.prefetch(cache=False)
+            if after is not None:
+                after.wait()
+            return self.play()
+
+        # gTTS synthesizes long texts in several requests, so the first
+        # chunks of MP3 are available long before the last.
+        chunks: queue.Queue = queue.Queue()
+
+        def produce():
+            try:
+                for chunk in self.gtts.stream():
+                    chunks.put(chunk)
+            except ImportError as err:
+                chunks.put(_Unavailable(f"cannot import gtts: {err}"))
+            except _gtts().gTTSError as err:
+                chunks.put(_Unavailable(str(err)))
+            except Exception as err:
+                chunks.put(err)
+            finally:
+                chunks.put(None)
+
+        threading.Thread(target=produce, daemon=True).start()
+        if after is not None:
+            after.wait()
+
+        chunk = chunks.get()
+        if isinstance(chunk, _Unavailable):
+            if not HAVE_ESPEAK:
+                raise chunk
+            logging.warning("Cannot use gTTS, falling back to espeak-ng: %s", chunk)
+            _gtts_failed()
+            Speech(self.text, False, self.lang, self.slow, "espeak-ng").play()
+            return
+
+        logging.info("Speaking: %s", self.text)
         with subprocess.Popen(
-            ["play", "-q", "-t", "mp3", "-", "delay", "0.1"],
+            [PLAY, "-q", "-t", "mp3", "-", "delay", "0.1"],
             stdin=subprocess.PIPE,
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT,
-            close_fds=True,
+            close_fds=False,
         ) as proc:
-            stdout, _ = proc.communicate(self.audio.getvalue())
-            if proc.returncode != 0:
-                raise RuntimeError(f"error running play:\n{stdout.decode()}")
+            while isinstance(chunk, bytes):
+                proc.stdin.write(chunk)
+                proc.stdin.flush()
+                chunk = chunks.get()
+            stdout, _ = proc.communicate()
+        if isinstance(chunk, _Unavailable):
+            logging.warning("Speech was cut short: %s", chunk)
+            _gtts_failed()
+        elif isinstance(chunk, Exception):
+            raise chunk
+        if proc.returncode != 0:
+            raise RuntimeError(f"error running play:\n{stdout.decode()}")
 
 
 class Beep:
@@ -95,10 +474,10 @@ class Beep:
         self.duration = duration
 
     def play(self) -> None:
-        logging.info(f"Beeping: {self.hz} Hz for {self.duration} s.")
+        logging.info("Beeping: %s Hz for %s s.", self.hz, self.duration)
         with subprocess.Popen(
             [
-                "play",
+                PLAY,
                 "-q",
                 "-n",
                 "-c1",
@@ -109,13 +488,33 @@ class Beep:
             ],
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT,
-            close_fds=True,
+            close_fds=False,
         ) as proc:
             stdout, _ = proc.communicate()
             if proc.returncode != 0:
                 raise RuntimeError(f"error running play:\n{stdout.decode()}")
 
 
+def _espeak(text: str, lang: str, slow: bool) -> bytes:
+    """Synthesize text offline with espeak-ng and return it as WAV."""
+    args = [ESPEAK, "--stdin", "--stdout", "-v", lang]
+    if slow:
+        args += ["-s", "120"]
+    return subprocess.run(
+        args, input=text.encode("utf-8"), stdout=subprocess.PIPE, check=True
+    ).stdout
+
+
+def _to_pcm(data: bytes, filetype: str) -> bytes:
+    """Decode audio of the given type into PCM_FORMAT with SoX."""
+    return subprocess.run(
+        [SOX, "-q", "-t", filetype, "-", *PCM_FORMAT, "-"],
+        input=data,
+        stdout=subprocess.PIPE,
+        check=True,
+    ).stdout
+
+
 def conjoin(conjunction: str, xs: List[str]) -> str:
     assert len(xs) != 0
     n = len(xs)
@@ -124,4 +523,4 @@ def conjoin(conjunction: str, xs: List[str]) -> str:
     elif n == 2:
         return f"{xs[0]} {conjunction} {xs[1]}"
     else:
-        return ", ".join(xs[:-1]) + " " + conjunction + " " + xs[-1]
+        return f"{', '.join(xs[:-1])}, {conjunction} {xs[-1]}"
@@ -1,5 +1,13 @@
+import functools
 import re
 
+try:
+    # RE2 matches in linear time without backtracking, which helps when
+    # searching large libraries on every key press.
+    import re2
+except ImportError:
+    re2 = None
+
 VANITY_MAP = {
     "1": ".@/",
     "2": "ABC",
@@ -33,33 +41,63 @@ MODES = [
 ]
 
 
-def to_regex(numbers: str, mode: str = "linear") -> re.Pattern:
+@functools.lru_cache(maxsize=512)
+def to_regex(numbers: str, mode: str = "linear", flags: int = 0) -> re.Pattern:
     if mode == "linear":
-        return to_regex_linear(numbers, False)
+        return to_regex_linear(numbers, False, flags)
     elif mode == "strict":
-        return to_regex_linear(numbers, True)
+        return to_regex_linear(numbers, True, flags)
     elif mode == "fuzzy":
-        return to_regex_fuzzy(numbers)
+        return to_regex_fuzzy(numbers, flags)
     else:
         raise RuntimeError(f"unknown mode {mode}, expect one of linear, strict, fuzzy")
 
 
-def to_regex_linear(numbers: str, strict: bool = False) -> re.Pattern:
+def _compile(regex: str, flags: int) -> re.Pattern:
+    """Compile a case-insensitive regex with RE2 if available, otherwise re.
+
+    Errors are raised as re.error with either engine. Case folding differs
+    slightly: RE2 uses simple Unicode folding, so unlike re it does not match
+    the Turkish dotted and dotless I against [GHI].
+    """
+    flags |= re.IGNORECASE
+    if re2 is None or flags & ~(re.IGNORECASE | re.MULTILINE):
+        return re.compile(regex, flags)
+    # RE2 takes the flags inline rather than as re constants.
+    inline = "i" + ("m" if flags & re.MULTILINE else "")
+    options = re2.Options()
+    options.log_errors = False
+    try:
+        return re2.compile(f"(?{inline}){regex}", options)
+    except re2.error as err:
+        msg = err.args[0] if err.args else "invalid pattern"
+        if isinstance(msg, bytes):
+            msg = msg.decode("utf-8", "replace")
+        raise re.error(msg, regex) from err
+
+
+def narrows(numbers: str, char: str, mode: str = "linear") -> bool:
+    """Return True if appending char to numbers can only remove matches.
+
+    Then the results for numbers can be filtered instead of searching again.
+    This holds except in linear and strict mode for a second 0, which turns
+    the . of the first into .* and thereby matches more.
+    """
+    return mode == "fuzzy" or not (char == "0" and numbers.endswith("0"))
+
+
+@functools.lru_cache(maxsize=512)
+def to_regex_linear(numbers: str, strict: bool = False, flags: int = 0) -> re.Pattern:
     """Convert a string of numbers into a fuzzy vanity regular expression pattern."""
-    regex = ""
+    chars = [char for char in numbers if char in REGEX_MAP]
+    has_slash = "1" in chars
+    parts = []
     prev = None
-    has_slash = False
-    for char in numbers:
-        if char not in REGEX_MAP:
-            continue
-        if char == "1":
-            has_slash = True
-        if char == "0" and prev == "0":
-            # Double 0 translates to .*
-            regex += "*"
-        else:
-            regex += REGEX_MAP[char]
+    for char in chars:
+        # Double 0 translates to .*
+        parts.append("*" if char == "0" and prev == "0" else REGEX_MAP[char])
         prev = char
+    regex = "".join(parts)
 
     # If no slash has been specified, assume we're searching for artist.
     if not has_slash:
@@ -69,18 +107,13 @@ def to_regex_linear(numbers: str, strict: bool = False) -> re.Pattern:
     if strict and regex[0] != "/":
         regex = "^" + regex
 
-    return re.compile(regex, re.IGNORECASE)
+    return _compile(regex, flags)
 
 
-def to_regex_fuzzy(numbers: str) -> re.Pattern:
-    regex = ""
-    has_slash = False
-    for char in numbers:
-        if char not in REGEX_MAP:
-            continue
-        if char == "1":
-            has_slash = True
-        regex += REGEX_MAP[char] + ".*"
-    if not has_slash:
+@functools.lru_cache(maxsize=512)
+def to_regex_fuzzy(numbers: str, flags: int = 0) -> re.Pattern:
+    chars = [char for char in numbers if char in REGEX_MAP]
+    regex = "".join(REGEX_MAP[char] + ".*" for char in chars)
+    if "1" not in chars:
         regex += "/"
-    return re.compile(regex, re.IGNORECASE)
+    return _compile(regex, flags)
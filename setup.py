@@ -18,7 +18,9 @@ setup(
         "python-mpd2",
         "readchar",
         "pyyaml",
+        "requests",
     ],
+    extras_require={"re2": ["google-re2"]},
     packages=["mpd_remote"],
     package_dir={"": "."},
     package_data={},